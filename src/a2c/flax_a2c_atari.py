@@ -1,6 +1,7 @@
 import argparse
 import functools
 import time
+from collections import defaultdict
 from datetime import datetime
 
 import gymnasium as gym
@@ -27,6 +28,8 @@ def parse_args():
     parser.add_argument("--value_coef", type=float, default=0.5)
     parser.add_argument("--entropy_coef", type=float, default=0.01)
     parser.add_argument("--clip_grad_norm", type=float, default=0.5)
+    parser.add_argument("--bf16", action="store_true")
+    parser.add_argument("--log_interval", type=int, default=10)
     parser.add_argument("--capture_video", action="store_true")
     parser.add_argument("--wandb", action="store_true")
     parser.add_argument("--seed", type=int, default=0)
@@ -66,19 +69,26 @@ def make_env(env_id, capture_video=False, run_dir="."):
     return thunk
 
 
-@functools.partial(jax.jit, static_argnums=(4, 5, 6, 7))
-def compute_advantages(rewards, values, flags, last_value, gamma, gae, num_steps, num_envs):
-    advantages = jnp.zeros((num_steps, num_envs))
-    adv = jnp.zeros(num_envs)
+@jax.jit
+def compute_advantages(rewards, values, flags, last_value, gamma, gae):
+    def scan_fn(carry, transition):
+        adv, last_value = carry
+        reward, value, flag = transition
 
-    for i in reversed(range(num_steps)):
-        returns = rewards[i] + gamma * flags[i] * last_value
-        delta = returns - values[i]
+        returns = reward + gamma * flag * last_value
+        delta = returns - value
 
-        adv = delta + gamma * gae * flags[i] * adv
-        advantages = advantages.at[i].set(adv)
+        adv = delta + gamma * gae * flag * adv
 
-        last_value = values[i]
+        return (adv, value), adv
+
+    # Reverse scan over the rollout
+    _, advantages = jax.lax.scan(
+        scan_fn,
+        (jnp.zeros_like(last_value), last_value),
+        (rewards, values, flags),
+        reverse=True,
+    )
 
     return advantages
 
@@ -108,7 +118,7 @@ def policy_evaluate(apply_fn, params, states, actions):
     return log_probs, entropy, value
 
 
-@functools.partial(jax.jit, static_argnums=(2, 3))
+@functools.partial(jax.jit, static_argnums=(2, 3), donate_argnums=0)
 def train_step(train_state, batch, value_coef, entropy_coef):
     def loss_fn(params):
         states, actions, advantages, td_target = batch
@@ -130,53 +140,74 @@ def train_step(train_state, batch, value_coef, entropy_coef):
     return train_state, loss
 
 
+@functools.partial(jax.jit, donate_argnums=0)
+def buffer_push(buffer, step, transition):
+    return {**buffer, **{name: buffer[name].at[step].set(value) for name, value in transition.items()}}
+
+
 class RolloutBuffer:
     def __init__(self, num_steps, num_envs, observation_shape):
-        self.states = np.zeros((num_steps, num_envs, *observation_shape), dtype=np.float32)
-        self.actions = np.zeros((num_steps, num_envs), dtype=np.int64)
-        self.rewards = np.zeros((num_steps, num_envs), dtype=np.float32)
-        self.flags = np.zeros((num_steps, num_envs), dtype=np.float32)
-        self.values = np.zeros((num_steps, num_envs), dtype=np.float32)
+        # Buffers live on device and are updated in place
+        self.buffer = {
+            "states": jnp.zeros((num_steps, num_envs, *observation_shape), dtype=jnp.uint8),
+            "actions": jnp.zeros((num_steps, num_envs), dtype=jnp.int32),
+            "rewards": jnp.zeros((num_steps, num_envs), dtype=jnp.float32),
+            "flags": jnp.zeros((num_steps, num_envs), dtype=jnp.float32),
+            "values": jnp.zeros((num_steps, num_envs), dtype=jnp.float32),
+        }
 
         self.step = 0
         self.num_steps = num_steps
 
-    def push(self, state, action, reward, flag, value):
-        self.states[self.step] = state
-        self.actions[self.step] = action
-        self.rewards[self.step] = reward
-        self.flags[self.step] = flag
-        self.values[self.step] = value
+    def push(self, state, action, value):
+        self.buffer = buffer_push(self.buffer, self.step, {"states": state, "actions": action, "values": value})
+
+    def push_outcome(self, reward, flag):
+        self.buffer = buffer_push(self.buffer, self.step, {"rewards": reward, "flags": flag})
 
         self.step = (self.step + 1) % self.num_steps
 
     def get(self):
-        return self.states, self.actions, self.rewards, self.flags, self.values
+        return tuple(self.buffer[name] for name in ("states", "actions", "rewards", "flags", "values"))
 
 
 class ActorCriticNet(nn.Module):
     action_dim: int
+    dtype: jnp.dtype = jnp.float32
 
     @nn.compact
     def __call__(self, state):
-        output = nn.Conv(features=32, kernel_size=(8, 8), strides=(4, 4))(state)
+        # Frames are kept as uint8 until here
+        state = (state.astype(jnp.float32) / 255.0).astype(self.dtype)
+
+        # Parameters stay in float32
+        output = nn.Conv(features=32, kernel_size=(8, 8), strides=(4, 4), dtype=self.dtype)(state)
         output = nn.relu(output)
-        output = nn.Conv(features=64, kernel_size=(4, 4), strides=(2, 2))(output)
+        output = nn.Conv(features=64, kernel_size=(4, 4), strides=(2, 2), dtype=self.dtype)(output)
         output = nn.relu(output)
-        output = nn.Conv(features=64, kernel_size=(3, 3), strides=(1, 1))(output)
+        output = nn.Conv(features=64, kernel_size=(3, 3), strides=(1, 1), dtype=self.dtype)(output)
         output = nn.relu(output)
         output = output.reshape((output.shape[0], -1))
-        output = nn.Dense(features=512)(output)
+        output = nn.Dense(features=512, dtype=self.dtype)(output)
         output = nn.relu(output)
 
-        logits = nn.Dense(features=self.action_dim)(output)
+        # Heads are cast back to float32
+        logits = nn.Dense(features=self.action_dim, dtype=self.dtype)(output).astype(jnp.float32)
         distribution = Categorical(logits=logits)
 
-        value = nn.Dense(features=1)(output)
+        value = nn.Dense(features=1, dtype=self.dtype)(output).astype(jnp.float32)
 
         return distribution, value.squeeze()
 
 
+def log_metrics(writer, metrics, global_step):
+    # Write the mean of each metric
+    for name, values in metrics.items():
+        writer.add_scalar(name, np.mean(jax.device_get(values)), global_step)
+
+    metrics.clear()
+
+
 def train(args, run_name, run_dir):
     # Initialize wandb if needed (https://wandb.ai/)
     if args.wandb:
@@ -211,7 +242,7 @@ def train(args, run_name, run_dir):
     key, model_key = jax.random.split(jax.random.PRNGKey(args.seed))
 
     # Create policy network and optimizer
-    policy_net = ActorCriticNet(action_dim=action_dim)
+    policy_net = ActorCriticNet(action_dim=action_dim, dtype=jnp.bfloat16 if args.bf16 else jnp.float32)
     init_params = policy_net.init(model_key, state)
 
     optimizer = optax.chain(
@@ -229,10 +260,11 @@ def train(args, run_name, run_dir):
 
     global_step = 0
     log_episodic_returns, log_episodic_lengths = [], []
+    metrics = defaultdict(list)
     start_time = time.process_time()
 
     # Main loop
-    for _ in tqdm(range(args.num_updates)):
+    for update in tqdm(range(args.num_updates)):
         for _ in range(args.num_steps):
             # Update global step
             global_step += 1 * args.num_envs
@@ -241,11 +273,13 @@ def train(args, run_name, run_dir):
             action, value, key = policy_predict(train_state.apply_fn, train_state.params, state, key)
 
             # Perform action
-            next_state, reward, terminated, truncated, infos = envs.step(jax.device_get(action))
+            envs.step_async(jax.device_get(action))
+            rollout_buffer.push(state, action, value)
+            next_state, reward, terminated, truncated, infos = envs.step_wait()
 
-            # Store transition
+            # Store outcome of the transition
             flag = 1.0 - np.logical_or(terminated, truncated)
-            rollout_buffer.push(state, action, reward, flag, value)
+            rollout_buffer.push_outcome(reward, flag)
 
             state = next_state
 
@@ -259,8 +293,8 @@ def train(args, run_name, run_dir):
 
                 log_episodic_returns.append(info["episode"]["r"])
                 log_episodic_lengths.append(info["episode"]["l"])
-                writer.add_scalar("rollout/episodic_return", np.mean(log_episodic_returns[-5:]), global_step)
-                writer.add_scalar("rollout/episodic_length", np.mean(log_episodic_lengths[-5:]), global_step)
+                metrics["rollout/episodic_return"].append(info["episode"]["r"])
+                metrics["rollout/episodic_length"].append(info["episode"]["l"])
 
         # Get transition batch
         states, actions, rewards, flags, values = rollout_buffer.get()
@@ -268,16 +302,7 @@ def train(args, run_name, run_dir):
         last_value = policy_critic(train_state.apply_fn, train_state.params, next_state)
 
         # Calculate advantages and TD target
-        advantages = compute_advantages(
-            rewards,
-            values,
-            flags,
-            last_value,
-            args.gamma,
-            args.gae,
-            args.num_steps,
-            args.num_envs,
-        )
+        advantages = compute_advantages(rewards, values, flags, last_value, args.gamma, args.gae)
         td_target = advantages + values
 
         # Normalize advantages
@@ -294,9 +319,15 @@ def train(args, run_name, run_dir):
         # Perform A2C update
         train_state, loss = train_step(train_state, batch, args.value_coef, args.entropy_coef)
 
-        # Log training metrics
-        writer.add_scalar("rollout/SPS", int(global_step / (time.process_time() - start_time)), global_step)
-        writer.add_scalar("train/loss", jax.device_get(loss), global_step)
+        # Store training metrics
+        metrics["rollout/SPS"].append(int(global_step / (time.process_time() - start_time)))
+        metrics["train/loss"].append(loss)
+
+        if (update + 1) % args.log_interval == 0:
+            log_metrics(writer, metrics, global_step)
+
+    # Log the metrics of the last incomplete interval
+    log_metrics(writer, metrics, global_step)
 
     # Close the environment
     envs.close()
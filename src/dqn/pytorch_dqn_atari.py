@@ -191,6 +191,10 @@ def train(args, run_name, run_dir):
     target_policy = QNetwork(action_dim, args.device)
     target_policy.load_state_dict(policy.state_dict())
 
+    # Parameters of the target network synchronization
+    policy_params = list(policy.parameters())
+    target_params = list(target_policy.parameters())
+
     optimizer = optim.Adam(policy.parameters(), lr=args.learning_rate)
 
     # Create the replay buffer
@@ -267,7 +271,8 @@ def train(args, run_name, run_dir):
 
             # Update target network
             if not global_step % args.target_update_frequency:
-                target_policy.load_state_dict(policy.state_dict())
+                with torch.no_grad():
+                    torch._foreach_copy_(target_params, policy_params)  # noqa: SLF001
 
             # Log training metrics
             writer.add_scalar("rollout/SPS", int(global_step / (time.process_time() - start_time)), global_step)
@@ -1,5 +1,6 @@
 import argparse
 import time
+from collections import defaultdict
 from datetime import datetime
 
 import gymnasium as gym
@@ -15,6 +16,7 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--env_id", type=str, default="LunarLander-v2")
     parser.add_argument("--total_timesteps", type=int, default=500_000)
+    parser.add_argument("--num_envs", type=int, default=1)
     parser.add_argument("--batch_size", type=int, default=64)
     parser.add_argument("--buffer_size", type=int, default=25_000)
     parser.add_argument("--learning_rate", type=float, default=3e-4)
@@ -26,7 +28,12 @@ def parse_args():
     parser.add_argument("--learning_start", type=int, default=10_000)
     parser.add_argument("--train_frequency", type=int, default=10)
     parser.add_argument("--target_update_frequency", type=int, default=1_000)
+    parser.add_argument("--vec_backend", type=str, default="async", choices=["async", "sync", "numpy"])
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--cuda_graph", action="store_true")
+    parser.add_argument("--amp", action="store_true")
     parser.add_argument("--cpu", action="store_true")
+    parser.add_argument("--log_interval", type=int, default=1_000)
     parser.add_argument("--capture_video", action="store_true")
     parser.add_argument("--wandb", action="store_true")
     parser.add_argument("--seed", type=int, default=0)
@@ -34,6 +41,18 @@ def parse_args():
     args = parser.parse_args()
 
     args.device = torch.device("cpu" if args.cpu or not torch.cuda.is_available() else "cuda")
+    args.cuda_graph = args.cuda_graph and args.device.type == "cuda"
+    args.amp = args.amp and args.device.type == "cuda"
+
+    # The gradient scaler cannot be captured in a CUDA graph
+    if args.amp and args.cuda_graph:
+        parser.error("--amp and --cuda_graph cannot be used together")
+
+    # The target network is synchronized at most once per iteration
+    if args.num_envs > args.target_update_frequency:
+        parser.error("--num_envs cannot exceed --target_update_frequency")
+
+    args.num_iterations = int(args.total_timesteps // args.num_envs)
 
     return args
 
@@ -58,52 +77,164 @@ def make_env(env_id, capture_video=False, run_dir="."):
     return thunk
 
 
+def make_vector_env(env_id, num_envs, vec_backend):
+    # Environments without a vectorized entry point fall back to the sync backend
+    if vec_backend == "numpy":
+        if gym.spec(env_id).vector_entry_point is not None:
+            # Episode statistics are batched in infos["episode"] by the vector wrapper
+            env = gym.make_vec(env_id, num_envs=num_envs, vectorization_mode="custom")
+            return gym.experimental.wrappers.vector.RecordEpisodeStatisticsV0(env)
+
+        vec_backend = "sync"
+
+    # A single environment is stepped in process
+    if vec_backend == "sync" or num_envs == 1:
+        return gym.vector.SyncVectorEnv([make_env(env_id) for _ in range(num_envs)])
+
+    # Observations are shared without copy, they are overwritten by the next step
+    return gym.vector.AsyncVectorEnv(
+        [make_env(env_id) for _ in range(num_envs)],
+        shared_memory=True,
+        copy=False,
+        context="forkserver",
+    )
+
+
+def get_finished_episodes(infos):
+    # Statistics of the finished episodes, as Python scalars
+    if "final_info" in infos:
+        return [
+            (info["episode"]["r"].item(), info["episode"]["l"].item())
+            for info in infos["final_info"][infos["_final_info"]]
+        ]
+
+    if "episode" in infos:
+        finished = infos["_episode"]
+        return list(zip(infos["episode"]["r"][finished].tolist(), infos["episode"]["l"][finished].tolist()))
+
+    return []
+
+
 def get_exploration_prob(eps_start, eps_end, eps_decay, step):
     return eps_end + (eps_start - eps_end) * np.exp(-1.0 * step / eps_decay)
 
 
 class ReplayBuffer:
-    def __init__(self, buffer_size, batch_size, observation_shape, numpy_rng, device):
-        self.states = np.zeros((buffer_size, *observation_shape), dtype=np.float32)
-        self.actions = np.zeros((buffer_size,), dtype=np.int64)
-        self.rewards = np.zeros((buffer_size,), dtype=np.float32)
-        self.flags = np.zeros((buffer_size,), dtype=np.float32)
+    def __init__(self, buffer_size, batch_size, num_envs, observation_shape, device):
+        # Rows of num_envs transitions, the next state of a transition is read from the next row
+        self.max_size = buffer_size // num_envs
+        self.states = torch.zeros((self.max_size, num_envs, *observation_shape), dtype=torch.float32, device=device)
+        self.actions = torch.zeros((self.max_size, num_envs), dtype=torch.int64, device=device)
+
+        # Pinned host buffer staging the rewards and flags
+        self.outcomes = torch.zeros((self.max_size, num_envs, 2), dtype=torch.float32, device=device)
+        self.rewards = self.outcomes[..., 0]
+        self.flags = self.outcomes[..., 1]
+
+        self.outcome_pin = torch.empty((num_envs, 2), dtype=torch.float32, pin_memory=device.type == "cuda")
+        self.outcome_np = self.outcome_pin.numpy()
 
         self.batch_size = batch_size
-        self.max_size = buffer_size
+        self.num_envs = num_envs
         self.idx = 0
         self.size = 0
 
-        self.numpy_rng = numpy_rng
         self.device = device
 
     def push(self, state, action, reward, flag):
+        # State and action are already on device
         self.states[self.idx] = state
         self.actions[self.idx] = action
-        self.rewards[self.idx] = reward
-        self.flags[self.idx] = flag
+
+        self.outcome_np[:, 0] = reward
+        self.outcome_np[:, 1] = flag
+
+        # Copy the outcomes to device
+        self.outcomes[self.idx].copy_(self.outcome_pin, non_blocking=True)
 
         self.idx = (self.idx + 1) % self.max_size
         self.size = min(self.size + 1, self.max_size)
 
     def sample(self):
-        idxs = self.numpy_rng.integers(0, self.size - 1, size=self.batch_size)
+        # The newest step has no next state yet
+        start = self.idx if self.size == self.max_size else 0
+        offsets = torch.randint(0, self.size - 1, (self.batch_size,), device=self.device)
+        envs = torch.randint(0, self.num_envs, (self.batch_size,), device=self.device)
+
+        idxs = (start + offsets) % self.max_size
+        next_idxs = (idxs + 1) % self.max_size
 
         return (
-            torch.from_numpy(self.states[idxs]).to(self.device),
-            torch.from_numpy(self.actions[idxs]).unsqueeze(-1).to(self.device),
-            torch.from_numpy(self.rewards[idxs]).to(self.device),
-            torch.from_numpy(self.states[idxs + 1]).to(self.device),
-            torch.from_numpy(self.flags[idxs]).to(self.device),
+            self.states[idxs, envs],
+            self.actions[idxs, envs],
+            self.rewards[idxs, envs],
+            self.states[next_idxs, envs],
+            self.flags[idxs, envs],
         )
 
 
+class CUDAGraphStep:
+    def __init__(self, fn, tensors=(), optimizers=(), num_warmup=3):
+        # Captures fn in a CUDA graph (https://pytorch.org/docs/stable/notes/cuda.html#cuda-graphs)
+        self.fn = fn
+        self.tensors = list(tensors)
+        self.optimizers = optimizers
+        self.num_warmup = num_warmup
+        self.graph = None
+
+    def _capture(self, inputs):
+        self.static_inputs = tuple(value.clone() for value in inputs)
+        snapshot = [tensor.detach().clone() for tensor in self.tensors]
+
+        # Warmup on a side stream
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.num_warmup):
+                self.fn(*self.static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # Undo the warmup updates
+        with torch.no_grad():
+            torch._foreach_copy_(self.tensors, snapshot)  # noqa: SLF001
+
+            for optimizer in self.optimizers:
+                for state in optimizer.state.values():
+                    for value in state.values():
+                        if torch.is_tensor(value):
+                            value.zero_()
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_output = self.fn(*self.static_inputs)
+
+    def __call__(self, *inputs):
+        if self.graph is None:
+            self._capture(inputs)
+
+        for static_input, value in zip(self.static_inputs, inputs):
+            static_input.copy_(value)
+
+        self.graph.replay()
+
+        # The static output is overwritten by the next replay
+        return self.static_output
+
+
+def log_metrics(writer, metrics, global_step):
+    # Write the mean of each metric
+    for name, values in metrics.items():
+        writer.add_scalar(name, np.mean([float(value) for value in values]), global_step)
+
+    metrics.clear()
+
+
 class QNetwork(nn.Module):
     def __init__(self, observation_shape, action_dim, list_layer, device):
         super().__init__()
 
         self.network = self._build_net(observation_shape, list_layer)
-        self.network.append(self._build_linear(list_layer[-1], action_dim))
+        self.network.append(self._build_linear(list_layer[-1], int(action_dim)))
 
         if device.type == "cuda":
             self.cuda()
@@ -119,7 +250,7 @@ class QNetwork(nn.Module):
 
     def _build_net(self, observation_shape, hidden_layers):
         layers = nn.Sequential()
-        in_size = np.prod(observation_shape)
+        in_size = int(np.prod(observation_shape))
 
         for out_size in hidden_layers:
             layers.append(self._build_linear(in_size, out_size))
@@ -153,8 +284,8 @@ def train(args, run_name, run_dir):
         "|param|value|\n|-|-|\n%s" % ("\n".join([f"|{key}|{value}|" for key, value in vars(args).items()])),
     )
 
-    # Create vectorized environment
-    env = gym.vector.SyncVectorEnv([make_env(args.env_id)])
+    # Create vectorized environment(s)
+    env = make_vector_env(args.env_id, args.num_envs, args.vec_backend)
 
     # Metadata about the environment
     observation_shape = env.single_observation_space.shape
@@ -162,97 +293,154 @@ def train(args, run_name, run_dir):
 
     # Set seed for reproducibility
     if args.seed:
-        numpy_rng = np.random.default_rng(args.seed)
         torch.manual_seed(args.seed)
         state, _ = env.reset(seed=args.seed)
     else:
-        numpy_rng = np.random.default_rng()
         state, _ = env.reset()
 
     # Create the networks and the optimizer
     policy = QNetwork(observation_shape, action_dim, args.list_layer, args.device)
-    target_policy = QNetwork(observation_shape, action_dim, args.list_layer, args.device)
-    target_policy.load_state_dict(policy.state_dict())
 
-    optimizer = optim.Adam(policy.parameters(), lr=args.learning_rate)
+    # Create the target network, its weights are copied from the policy
+    with torch.device("meta"):
+        target_policy = QNetwork(observation_shape, action_dim, args.list_layer, torch.device("meta"))
+    target_policy.to_empty(device=args.device).requires_grad_(False)
+
+    # Script the networks, unless the training step is compiled
+    if not args.compile:
+        policy = torch.jit.script(policy)
+        target_policy = torch.jit.script(target_policy)
+
+    # Parameters of the target network synchronization
+    policy_params = list(policy.parameters())
+    target_params = list(target_policy.parameters())
+
+    with torch.no_grad():
+        torch._foreach_copy_(target_params, policy_params)  # noqa: SLF001
+
+    # Captured optimizer steps need their states on device
+    optimizer = optim.Adam(policy.parameters(), lr=args.learning_rate, capturable=args.cuda_graph)
+
+    # Scale the loss of the float16 autocast
+    scaler = torch.amp.GradScaler("cuda", enabled=args.amp)
 
     # Create the replay buffer
-    replay_buffer = ReplayBuffer(args.buffer_size, args.batch_size, observation_shape, numpy_rng, args.device)
+    replay_buffer = ReplayBuffer(args.buffer_size, args.batch_size, args.num_envs, observation_shape, args.device)
+
+    # Create a pinned host buffer for the state transfer
+    state_pin = torch.empty(
+        (args.num_envs, *observation_shape),
+        dtype=torch.float32,
+        pin_memory=args.device.type == "cuda",
+    )
+
+    # Batch row indices to select the Q-values
+    batch_idxs = torch.arange(args.batch_size, device=args.device)
+
+    # Host buffer of the episode ends
+    done = np.empty(args.num_envs, dtype=bool)
 
     # Remove unnecessary variables
     del observation_shape
 
+    def train_step(states, actions, rewards, next_states, flags):
+        with torch.autocast(device_type="cuda", dtype=torch.float16, enabled=args.amp):
+            # Compute TD error
+            td_predict = policy(states)[batch_idxs, actions]
+
+            # Compute TD target
+            with torch.inference_mode():
+                # Double Q-Learning
+                action_by_qvalue = policy(next_states).argmax(1)
+                max_q_target = target_policy(next_states)[batch_idxs, action_by_qvalue]
+
+            td_target = rewards + args.gamma * flags * max_q_target
+
+            # Compute loss
+            loss = mse_loss(td_predict, td_target)
+
+        # Update policy network
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+        return loss.detach()
+
+    # Compile the whole update (https://pytorch.org/docs/stable/torch.compiler.html)
+    if args.compile:
+        train_step = torch.compile(train_step, mode="default" if args.cuda_graph else "reduce-overhead")
+
+    # Capture the update in a CUDA graph
+    update_policy = CUDAGraphStep(train_step, policy_params, [optimizer]) if args.cuda_graph else train_step
+
     log_episodic_returns, log_episodic_lengths = [], []
-    start_time = time.process_time()
+    metrics = defaultdict(list)
+    start_time = time.perf_counter()
 
     # Main loop
-    for global_step in tqdm(range(args.total_timesteps)):
-        with torch.no_grad():
+    for iteration in tqdm(range(args.num_iterations)):
+        # Each iteration steps all environments, frequencies are counted in environment steps
+        global_step = iteration * args.num_envs
+
+        # Transfer the state to device
+        state_pin.copy_(torch.from_numpy(state))
+        state = state_pin.to(args.device, non_blocking=True)
+
+        with torch.inference_mode():
             # Exploration or intensification
             exploration_prob = get_exploration_prob(args.eps_start, args.eps_end, args.eps_decay, global_step)
 
-            # Log exploration probability
-            writer.add_scalar("rollout/eps_threshold", exploration_prob, global_step)
-
-            if numpy_rng.random() < exploration_prob:
-                # Exploration
-                action = torch.randint(action_dim, (1,)).to(args.device)
-            else:
-                # Intensification
-                action = policy(torch.from_numpy(state).to(args.device).float()).argmax(axis=1)
+            # Intensification and exploration are drawn for each environment
+            greedy_action = policy(state).argmax(axis=1)
+            random_action = torch.randint(0, action_dim, (args.num_envs,), device=args.device)
+            explore = torch.rand(args.num_envs, device=args.device) < exploration_prob
+            action = torch.where(explore, random_action, greedy_action)
 
         # Perform action
-        action = action.cpu().numpy()
-        next_state, reward, terminated, truncated, infos = env.step(action)
+        next_state, reward, terminated, truncated, infos = env.step(action.cpu().numpy())
 
         # Store transition in the replay buffer
-        flag = 1.0 - np.logical_or(terminated, truncated)
+        flag = np.logical_not(np.logical_or(terminated, truncated, out=done), out=done)
         replay_buffer.push(state, action, reward, flag)
 
         state = next_state
 
         # Log episodic return and length
-        if "final_info" in infos:
-            info = infos["final_info"][0]
-
-            log_episodic_returns.append(info["episode"]["r"])
-            log_episodic_lengths.append(info["episode"]["l"])
-            writer.add_scalar("rollout/episodic_return", np.mean(info["episode"]["r"][-5:]), global_step)
-            writer.add_scalar("rollout/episodic_length", np.mean(info["episode"]["l"][-5:]), global_step)
+        for episodic_return, episodic_length in get_finished_episodes(infos):
+            log_episodic_returns.append(episodic_return)
+            log_episodic_lengths.append(episodic_length)
+            metrics["rollout/episodic_return"].append(episodic_return)
+            metrics["rollout/episodic_length"].append(episodic_length)
 
         # Perform training step
         if global_step > args.learning_start:
-            if not global_step % args.train_frequency:
+            # One update per train_frequency environment steps
+            num_updates = global_step // args.train_frequency - (global_step - args.num_envs) // args.train_frequency
+
+            for _ in range(num_updates):
                 # Sample a batch from the replay buffer
                 states, actions, rewards, next_states, flags = replay_buffer.sample()
 
-                # Compute TD error
-                td_predict = policy(states).gather(1, actions).squeeze()
-
-                # Compute TD target
-                with torch.no_grad():
-                    # Double Q-Learning
-                    action_by_qvalue = policy(next_states).argmax(1).unsqueeze(-1)
-                    max_q_target = target_policy(next_states).gather(1, action_by_qvalue).squeeze()
-
-                td_target = rewards + args.gamma * flags * max_q_target
-
-                # Compute loss
-                loss = mse_loss(td_predict, td_target)
-
                 # Update policy network
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                loss = update_policy(states, actions, rewards, next_states, flags).clone()
 
-                writer.add_scalar("train/loss", loss, global_step)
+                # Store training metrics
+                metrics["train/loss"].append(loss)
 
             # Update target network
-            if not global_step % args.target_update_frequency:
-                target_policy.load_state_dict(policy.state_dict())
+            if global_step % args.target_update_frequency < args.num_envs:
+                with torch.no_grad():
+                    torch._foreach_copy_(target_params, policy_params)  # noqa: SLF001
 
         # Log training metrics
-        writer.add_scalar("rollout/SPS", int(global_step / (time.process_time() - start_time)), global_step)
+        if (global_step + args.num_envs) % args.log_interval < args.num_envs:
+            metrics["rollout/eps_threshold"].append(exploration_prob)
+            metrics["rollout/SPS"].append(int(global_step / (time.perf_counter() - start_time)))
+            log_metrics(writer, metrics, global_step)
+
+    # Log the remaining metrics
+    log_metrics(writer, metrics, global_step)
 
     # Save final policy
     torch.save(policy.state_dict(), f"{run_dir}/policy.pt")
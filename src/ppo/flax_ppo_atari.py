@@ -1,6 +1,7 @@
 import argparse
 import functools
 import time
+from collections import defaultdict
 from datetime import datetime
 
 import gymnasium as gym
@@ -10,7 +11,6 @@ import optax
 from flax import linen as nn
 from flax.training.train_state import TrainState
 from jax import numpy as jnp
-from tensorflow_probability.substrates.jax.distributions import Categorical
 from torch.utils.tensorboard.writer import SummaryWriter
 from tqdm import tqdm
 
@@ -30,6 +30,8 @@ def parse_args():
     parser.add_argument("--value_coef", type=float, default=0.5)
     parser.add_argument("--entropy_coef", type=float, default=0.01)
     parser.add_argument("--clip_grad_norm", type=float, default=0.5)
+    parser.add_argument("--envpool", action="store_true")
+    parser.add_argument("--log_interval", type=int, default=10)
     parser.add_argument("--capture_video", action="store_true")
     parser.add_argument("--wandb", action="store_true")
     parser.add_argument("--seed", type=int, default=0)
@@ -70,31 +72,110 @@ def make_env(env_id, capture_video=False, run_dir="."):
     return thunk
 
 
-@functools.partial(jax.jit, static_argnums=(4, 5, 6, 7))
-def compute_advantages(rewards, values, flags, last_value, gamma, gae, num_steps, num_envs):
-    advantages = jnp.zeros((num_steps, num_envs))
-    adv = jnp.zeros(num_envs)
+class EnvPoolVectorEnv:
+    def __init__(self, env_id, num_envs, seed):
+        # Optional dependency (https://github.com/sail-sg/envpool)
+        import envpool
 
-    for i in reversed(range(num_steps)):
-        returns = rewards[i] + gamma * flags[i] * last_value
-        delta = returns - values[i]
+        # Atari preprocessing and frame stacking are done by EnvPool
+        self.envs = envpool.make(
+            env_id.split("/")[-1],
+            env_type="gymnasium",
+            num_envs=num_envs,
+            batch_size=num_envs,
+            stack_num=4,
+            seed=seed,
+        )
+
+        self.num_envs = num_envs
+        self.single_observation_space = self.envs.observation_space
+        self.single_action_space = self.envs.action_space
+
+        # Track episode statistics
+        self.episode_returns = np.zeros(num_envs, dtype=np.float32)
+        self.episode_lengths = np.zeros(num_envs, dtype=np.int32)
+        self.prev_dones = np.zeros(num_envs, dtype=bool)
+
+    def reset(self):
+        # EnvPool seeds the environments at creation
+        self.episode_returns[:] = 0.0
+        self.episode_lengths[:] = 0
+        self.prev_dones[:] = False
+
+        return self.envs.reset()
+
+    def step(self, action):
+        next_state, reward, terminated, truncated, infos = self.envs.step(action)
+
+        # EnvPool resets finished environments on the next step, which ignores the action
+        infos["autoreset"] = self.prev_dones
+
+        self.episode_returns += reward
+        self.episode_lengths += ~self.prev_dones
+
+        # Report finished episodes like the gymnasium vector environments
+        dones = np.logical_or(terminated, truncated)
+        self.prev_dones = dones
+
+        if dones.any():
+            infos["final_info"] = np.array(
+                [
+                    {"episode": {"r": self.episode_returns[i], "l": self.episode_lengths[i]}} if done else None
+                    for i, done in enumerate(dones)
+                ],
+                dtype=object,
+            )
+            infos["_final_info"] = dones
+
+            self.episode_returns[dones] = 0.0
+            self.episode_lengths[dones] = 0
+
+        return next_state, reward, terminated, truncated, infos
 
-        adv = delta + gamma * gae * flags[i] * adv
-        advantages = advantages.at[i].set(adv)
+    def close(self):
+        self.envs.close()
 
-        last_value = values[i]
+
+@jax.jit
+def compute_advantages(rewards, values, flags, last_value, gamma, gae):
+    def scan_fn(carry, transition):
+        adv, last_value = carry
+        reward, value, flag = transition
+
+        returns = reward + gamma * flag * last_value
+        delta = returns - value
+
+        adv = delta + gamma * gae * flag * adv
+
+        return (adv, value), adv
+
+    # Reverse scan over the rollout
+    _, advantages = jax.lax.scan(
+        scan_fn,
+        (jnp.zeros_like(last_value), last_value),
+        (rewards, values, flags),
+        reverse=True,
+    )
 
     return advantages
 
 
+def categorical_log_prob_entropy(logits, actions):
+    # Closed forms of the categorical log_prob and entropy
+    log_p = jax.nn.log_softmax(logits)
+    log_probs = jnp.take_along_axis(log_p, actions[..., None], axis=-1).squeeze(-1)
+    entropy = -(jnp.exp(log_p) * log_p).sum(-1)
+
+    return log_probs, entropy
+
+
 @functools.partial(jax.jit, static_argnums=0)
-def policy_predict(apply_fn, params, state, key):
-    dist, value = apply_fn(params, state)
-    key, action_key = jax.random.split(key)
-    action = dist.sample(seed=action_key)
-    log_prob = dist.log_prob(action)
+def policy_predict(apply_fn, params, state, keys, step):
+    logits, value = apply_fn(params, state)
+    action = jax.random.categorical(keys[step], logits)
+    log_prob, _ = categorical_log_prob_entropy(logits, action)
 
-    return action, log_prob, value, key
+    return action, log_prob, value
 
 
 @functools.partial(jax.jit, static_argnums=0)
@@ -106,15 +187,14 @@ def policy_critic(apply_fn, params, state):
 
 @functools.partial(jax.jit, static_argnums=0)
 def policy_evaluate(apply_fn, params, states, actions):
-    dist, value = apply_fn(params, states)
-    log_probs = dist.log_prob(actions)
-    entropy = dist.entropy()
+    logits, value = apply_fn(params, states)
+    log_probs, entropy = categorical_log_prob_entropy(logits, actions)
 
     return log_probs, entropy, value
 
 
-@functools.partial(jax.jit, static_argnums=(2, 3, 4, 5, 6))
-def train_step(train_state, trajectories, num_minibatches, minibatch_size, value_coef, entropy_coef, eps_clip):
+@functools.partial(jax.jit, static_argnums=(6, 7, 8, 9), donate_argnums=0)
+def train_step(train_state, rollout, last_value, keys, gamma, gae, num_minibatches, value_coef, entropy_coef, eps_clip):
     def loss_fn(params, batch):
         states, actions, old_log_probs, advantages, td_target = batch
 
@@ -133,43 +213,89 @@ def train_step(train_state, trajectories, num_minibatches, minibatch_size, value
 
         return loss
 
-    trajectories = jax.tree_util.tree_map(
-        lambda x: x.reshape((num_minibatches, minibatch_size) + x.shape[1:]),
-        trajectories,
-    )
-
-    for batch in zip(*trajectories):
+    def sgd_step(train_state, batch):
         grad_fn = jax.value_and_grad(loss_fn)
         loss, grads = grad_fn(train_state.params, batch)
         train_state = train_state.apply_gradients(grads=grads)
 
-    return train_state, loss
+        return train_state, loss
+
+    def epoch_step(train_state, key):
+        # Shuffle the batch and split it into minibatches
+        permutation = jax.random.permutation(key, trajectories[0].shape[0])
+        minibatches = jax.tree_util.tree_map(
+            lambda x: x[permutation].reshape((num_minibatches, -1) + x.shape[1:]),
+            trajectories,
+        )
+
+        # Scan over the minibatches
+        train_state, losses = jax.lax.scan(sgd_step, train_state, minibatches)
+
+        return train_state, losses[-1]
+
+    states, actions, rewards, flags, masks, log_probs, values = rollout
+
+    # Calculate advantages and TD target
+    advantages = compute_advantages(rewards, values, flags, last_value, gamma, gae) * masks
+    td_target = advantages + values
+
+    # Normalize advantages
+    advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8) * masks
+
+    # Flatten batch
+    trajectories = (
+        states.reshape(-1, *states.shape[2:]),
+        actions.reshape(-1),
+        log_probs.reshape(-1),
+        advantages.reshape(-1),
+        td_target.reshape(-1),
+    )
+
+    # Scan over the epochs, one key each
+    train_state, losses = jax.lax.scan(epoch_step, train_state, keys)
+
+    return train_state, losses[-1]
+
+
+@functools.partial(jax.jit, donate_argnums=0)
+def buffer_push(buffer, step, transition):
+    return {**buffer, **{name: buffer[name].at[step].set(value) for name, value in transition.items()}}
 
 
 class RolloutBuffer:
     def __init__(self, num_steps, num_envs, observation_shape):
-        self.states = np.zeros((num_steps, num_envs, *observation_shape), dtype=np.float32)
-        self.actions = np.zeros((num_steps, num_envs), dtype=np.int64)
-        self.rewards = np.zeros((num_steps, num_envs), dtype=np.float32)
-        self.flags = np.zeros((num_steps, num_envs), dtype=np.float32)
-        self.log_probs = np.zeros((num_steps, num_envs), dtype=np.float32)
-        self.values = np.zeros((num_steps, num_envs), dtype=np.float32)
+        # Buffers live on device and are updated in place
+        self.buffer = {
+            "states": jnp.zeros((num_steps, num_envs, *observation_shape), dtype=jnp.float32),
+            "actions": jnp.zeros((num_steps, num_envs), dtype=jnp.int32),
+            "rewards": jnp.zeros((num_steps, num_envs), dtype=jnp.float32),
+            "flags": jnp.zeros((num_steps, num_envs), dtype=jnp.float32),
+            "masks": jnp.zeros((num_steps, num_envs), dtype=jnp.float32),
+            "log_probs": jnp.zeros((num_steps, num_envs), dtype=jnp.float32),
+            "values": jnp.zeros((num_steps, num_envs), dtype=jnp.float32),
+        }
 
         self.step = 0
         self.num_steps = num_steps
 
-    def push(self, state, action, reward, flag, log_prob, value):
-        self.states[self.step] = state
-        self.actions[self.step] = action
-        self.rewards[self.step] = reward
-        self.flags[self.step] = flag
-        self.log_probs[self.step] = log_prob
-        self.values[self.step] = value
+    def push(self, state, action, reward, flag, mask, log_prob, value):
+        # Only reward, flag and mask come from host
+        transition = {
+            "states": state,
+            "actions": action,
+            "rewards": jax.device_put(reward),
+            "flags": jax.device_put(flag),
+            "masks": jax.device_put(mask),
+            "log_probs": log_prob,
+            "values": value,
+        }
+        self.buffer = buffer_push(self.buffer, self.step, transition)
 
         self.step = (self.step + 1) % self.num_steps
 
     def get(self):
-        return (self.states, self.actions, self.rewards, self.flags, self.log_probs, self.values)
+        names = ("states", "actions", "rewards", "flags", "masks", "log_probs", "values")
+        return tuple(self.buffer[name] for name in names)
 
 
 class ActorCriticNet(nn.Module):
@@ -188,11 +314,17 @@ class ActorCriticNet(nn.Module):
         output = nn.relu(output)
 
         logits = nn.Dense(features=self.action_dim)(output)
-        distribution = Categorical(logits=logits)
-
         value = nn.Dense(features=1)(output)
 
-        return distribution, value.squeeze()
+        return logits, value.squeeze()
+
+
+def log_metrics(writer, metrics, global_step):
+    # Write the mean of each metric
+    for name, values in metrics.items():
+        writer.add_scalar(name, np.mean(jax.device_get(values)), global_step)
+
+    metrics.clear()
 
 
 def train(args, run_name, run_dir):
@@ -217,14 +349,18 @@ def train(args, run_name, run_dir):
     )
 
     # Create vectorized environment(s)
-    envs = gym.vector.AsyncVectorEnv([make_env(args.env_id) for _ in range(args.num_envs)])
+    if args.envpool:
+        envs = EnvPoolVectorEnv(args.env_id, args.num_envs, args.seed)
+    else:
+        envs = gym.vector.AsyncVectorEnv([make_env(args.env_id) for _ in range(args.num_envs)])
 
     # Metadata about the environment
     observation_shape = envs.single_observation_space.shape
     action_dim = envs.single_action_space.n
 
     # Initialize state
-    state, _ = envs.reset(seed=args.seed) if args.seed else envs.reset()
+    state, _ = envs.reset(seed=args.seed) if args.seed and not args.envpool else envs.reset()
+    state = jnp.asarray(state)
 
     key, model_key = jax.random.split(jax.random.PRNGKey(args.seed))
 
@@ -247,25 +383,38 @@ def train(args, run_name, run_dir):
 
     global_step = 0
     log_episodic_returns, log_episodic_lengths = [], []
-    start_time = time.process_time()
+    metrics = defaultdict(list)
+    start_time = time.perf_counter()
 
     # Main loop
-    for _ in tqdm(range(args.num_updates)):
-        for _ in range(args.num_steps):
+    for update in tqdm(range(args.num_updates)):
+        # Split the action keys of the whole rollout
+        keys = jax.random.split(key, args.num_steps + 1)
+        key, rollout_keys = keys[0], keys[1:]
+
+        for step in range(args.num_steps):
             # Update global step
             global_step += 1 * args.num_envs
 
             # Get action
-            action, log_prob, value, key = policy_predict(train_state.apply_fn, train_state.params, state, key)
+            action, log_prob, value = policy_predict(
+                train_state.apply_fn,
+                train_state.params,
+                state,
+                rollout_keys,
+                step,
+            )
 
             # Perform action
-            next_state, reward, terminated, truncated, infos = envs.step(jax.device_get(action))
+            next_state, reward, terminated, truncated, infos = envs.step(np.asarray(action))
 
-            # Store transition
-            flag = 1.0 - np.logical_or(terminated, truncated)
-            rollout_buffer.push(state, action, reward, flag, log_prob, value)
+            # Store transition, masking out the EnvPool reset steps
+            mask = 1.0 - infos.get("autoreset", np.zeros(args.num_envs, dtype=bool))
+            flag = (1.0 - np.logical_or(terminated, truncated)) * mask
+            rollout_buffer.push(state, action, reward, flag, mask, log_prob, value)
 
-            state = next_state
+            # Transfer the observation to device
+            state = jnp.asarray(next_state)
 
             if "final_info" not in infos:
                 continue
@@ -277,58 +426,41 @@ def train(args, run_name, run_dir):
 
                 log_episodic_returns.append(info["episode"]["r"])
                 log_episodic_lengths.append(info["episode"]["l"])
-                writer.add_scalar("rollout/episodic_return", np.mean(log_episodic_returns[-5:]), global_step)
-                writer.add_scalar("rollout/episodic_length", np.mean(log_episodic_lengths[-5:]), global_step)
+                metrics["rollout/episodic_return"].append(info["episode"]["r"])
+                metrics["rollout/episodic_length"].append(info["episode"]["l"])
 
         # Get transition batch
-        states, actions, rewards, flags, log_probs, values = rollout_buffer.get()
+        rollout = rollout_buffer.get()
 
-        last_value = policy_critic(train_state.apply_fn, train_state.params, next_state)
+        last_value = policy_critic(train_state.apply_fn, train_state.params, state)
 
-        # Calculate advantages and TD target
-        advantages = compute_advantages(
-            rewards,
-            values,
-            flags,
+        # Perform PPO update
+        keys = jax.random.split(key, args.num_optims + 1)
+        key, epoch_keys = keys[0], keys[1:]
+
+        train_state, loss = train_step(
+            train_state,
+            rollout,
             last_value,
+            epoch_keys,
             args.gamma,
             args.gae,
-            args.num_steps,
-            args.num_envs,
-        )
-        td_target = advantages + values
-
-        # Normalize advantages
-        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
-
-        # Flatten batch
-        batch = (
-            states.reshape(-1, *observation_shape),
-            actions.reshape(-1),
-            log_probs.reshape(-1),
-            advantages.reshape(-1),
-            td_target.reshape(-1),
+            args.num_minibatches,
+            args.value_coef,
+            args.entropy_coef,
+            args.eps_clip,
         )
 
-        # Perform PPO update
-        for _ in range(args.num_optims):
-            key, subkey = jax.random.split(key)
-            permutation = jax.random.permutation(subkey, args.batch_size)
-            batch = tuple(x[permutation] for x in batch)
-
-            train_state, loss = train_step(
-                train_state,
-                batch,
-                args.num_minibatches,
-                args.minibatch_size,
-                args.value_coef,
-                args.entropy_coef,
-                args.eps_clip,
-            )
+        # Store training metrics
+        metrics["train/loss"].append(loss)
 
         # Log training metrics
-        writer.add_scalar("rollout/SPS", int(global_step / (time.process_time() - start_time)), global_step)
-        writer.add_scalar("train/loss", jax.device_get(loss), global_step)
+        if (update + 1) % args.log_interval == 0:
+            metrics["rollout/SPS"].append(int(global_step / (time.perf_counter() - start_time)))
+            log_metrics(writer, metrics, global_step)
+
+    # Log the metrics of the last incomplete interval
+    log_metrics(writer, metrics, global_step)
 
     # Close the environment
     envs.close()
@@ -1,12 +1,13 @@
 import argparse
+import math
 import time
+from collections import defaultdict
 from datetime import datetime
 
 import gymnasium as gym
 import numpy as np
 import torch
 from torch import nn, optim
-from torch.distributions import Normal
 from torch.nn.functional import mse_loss
 from torch.nn.utils.clip_grad import clip_grad_norm_
 from torch.utils.tensorboard.writer import SummaryWriter
@@ -30,7 +31,13 @@ def parse_args():
     parser.add_argument("--value_coef", type=float, default=0.5)
     parser.add_argument("--entropy_coef", type=float, default=0.01)
     parser.add_argument("--clip_grad_norm", type=float, default=0.5)
+    parser.add_argument("--normalize_obs", action="store_true")
+    parser.add_argument("--normalize_reward", action="store_true")
+    parser.add_argument("--fused_minibatches", action="store_true")
+    parser.add_argument("--sync_envs", action="store_true")
+    parser.add_argument("--compile", action="store_true")
     parser.add_argument("--cpu", action="store_true")
+    parser.add_argument("--log_interval", type=int, default=10)
     parser.add_argument("--capture_video", action="store_true")
     parser.add_argument("--wandb", action="store_true")
     parser.add_argument("--seed", type=int, default=0)
@@ -39,6 +46,11 @@ def parse_args():
 
     args.device = torch.device("cpu" if args.cpu or not torch.cuda.is_available() else "cuda")
     args.batch_size = int(args.num_envs * args.num_steps)
+
+    # Changes the algorithm, each epoch performs a single update on the whole batch
+    if args.fused_minibatches:
+        args.minibatch_size = args.batch_size
+
     args.num_minibatches = int(args.batch_size // args.minibatch_size)
     args.num_updates = int(args.total_timesteps // args.batch_size)
 
@@ -66,62 +78,159 @@ def make_env(env_id, capture_video=False, run_dir="."):
     return thunk
 
 
-def compute_advantages(rewards, flags, values, last_value, args):
-    advantages = torch.zeros((args.num_steps, args.num_envs)).to(args.device)
-    adv = torch.zeros(args.num_envs).to(args.device)
+@torch.jit.script
+def compute_advantages(rewards, flags, values, last_value, gamma: float, gae: float):
+    # TD errors of the whole rollout at once
+    next_values = torch.cat([values[1:], last_value.unsqueeze(0)])
+    deltas = rewards + gamma * flags * next_values - values
+    discounts = gamma * gae * flags
 
-    for i in reversed(range(args.num_steps)):
-        returns = rewards[i] + args.gamma * flags[i] * last_value
-        delta = returns - values[i]
+    advantages = torch.zeros_like(deltas)
+    adv = torch.zeros_like(last_value)
 
-        adv = delta + args.gamma * args.gae * flags[i] * adv
+    for i in range(deltas.shape[0] - 1, -1, -1):
+        adv = deltas[i] + discounts[i] * adv
         advantages[i] = adv
 
-        last_value = values[i]
-
     return advantages
 
 
+@torch.jit.script
+def compute_discounted_returns(rewards, flags, last_return, gamma: float):
+    # Running discounted returns of each environment
+    returns = torch.zeros_like(rewards)
+    ret = last_return
+
+    for i in range(rewards.shape[0]):
+        ret = rewards[i] + gamma * ret
+        returns[i] = ret
+        ret = ret * flags[i]
+
+    return returns, ret
+
+
+@torch.jit.script
+def normal_log_prob_entropy(mean, std, action):
+    # Closed forms of the Normal log_prob and entropy
+    log_std = std.log()
+    log_prob = -0.5 * ((action - mean) / std).pow(2) - log_std - 0.5 * math.log(2 * math.pi)
+    entropy = 0.5 + 0.5 * math.log(2 * math.pi) + log_std
+
+    return log_prob.sum(-1), entropy.sum(-1)
+
+
+def compute_loss(policy, states, actions, old_log_probs, advantages, td_target, eps_clip, value_coef, entropy_coef):
+    # Calculate new values from minibatch
+    log_probs, td_predict, entropy = policy.evaluate(states, actions)
+
+    # Calculate ratios
+    logratio = log_probs - old_log_probs
+    ratios = logratio.exp()
+
+    # Calculate surrogates
+    surr1 = advantages * ratios
+    surr2 = advantages * torch.clamp(ratios, 1.0 - eps_clip, 1.0 + eps_clip)
+
+    # Calculate losses
+    actor_loss = -torch.min(surr1, surr2).mean()
+    critic_loss = mse_loss(td_predict, td_target)
+    entropy_loss = entropy.mean()
+
+    loss = actor_loss + critic_loss * value_coef - entropy_loss * entropy_coef
+
+    return loss, actor_loss, critic_loss, logratio, ratios
+
+
+class RunningMeanStd:
+    def __init__(self, shape, device, epsilon=1e-4):
+        self.mean = torch.zeros(shape, dtype=torch.float32, device=device)
+        self.var = torch.ones(shape, dtype=torch.float32, device=device)
+        self.count = epsilon
+
+    def update(self, x):
+        # Parallel variant of Welford's algorithm
+        batch_mean = x.mean(0)
+        batch_var = x.var(0, unbiased=False)
+        batch_count = x.shape[0]
+
+        delta = batch_mean - self.mean
+        total_count = self.count + batch_count
+
+        self.mean = self.mean + delta * batch_count / total_count
+        self.var = (
+            self.var * self.count + batch_var * batch_count + delta.pow(2) * self.count * batch_count / total_count
+        ) / total_count
+        self.count = total_count
+
+    def normalize(self, x, clip=10.0):
+        return torch.clamp((x - self.mean) / torch.sqrt(self.var + 1e-8), -clip, clip)
+
+    def __call__(self, x, update=True):
+        if update:
+            self.update(x)
+
+        return self.normalize(x)
+
+    def state_dict(self):
+        return {"mean": self.mean, "var": self.var, "count": self.count}
+
+    def load_state_dict(self, state_dict):
+        self.mean = state_dict["mean"].to(self.mean.device)
+        self.var = state_dict["var"].to(self.var.device)
+        self.count = state_dict["count"]
+
+
 class RolloutBuffer:
     def __init__(self, num_steps, num_envs, observation_shape, action_shape, device):
-        self.states = np.zeros((num_steps, num_envs, *observation_shape), dtype=np.float32)
-        self.actions = np.zeros((num_steps, num_envs, *action_shape), dtype=np.float32)
-        self.rewards = np.zeros((num_steps, num_envs), dtype=np.float32)
-        self.flags = np.zeros((num_steps, num_envs), dtype=np.float32)
-        self.log_probs = np.zeros((num_steps, num_envs), dtype=np.float32)
-        self.values = np.zeros((num_steps, num_envs), dtype=np.float32)
+        fields = (int(np.prod(observation_shape)), int(np.prod(action_shape)), 1, 1, 1, 1)
+
+        # Single storage laid out as [state | action | log_prob | value | reward | flag]
+        self.storage = torch.zeros((num_steps, num_envs, sum(fields)), dtype=torch.float32, device=device)
+        states, actions, log_probs, values, rewards, flags = self.storage.split(fields, dim=-1)
+
+        self.states = states.view(num_steps, num_envs, *observation_shape)
+        self.actions = actions.view(num_steps, num_envs, *action_shape)
+        self.log_probs = log_probs.squeeze(-1)
+        self.values = values.squeeze(-1)
+        self.rewards = rewards.squeeze(-1)
+        self.flags = flags.squeeze(-1)
+
+        # Reward and flag are written as a single block
+        self.outcomes = self.storage[..., -2:]
 
         self.step = 0
         self.num_steps = num_steps
         self.device = device
 
-    def push(self, state, action, reward, flag, log_prob, value):
+    def push(self, state, action, log_prob, value):
         self.states[self.step] = state
         self.actions[self.step] = action
-        self.rewards[self.step] = reward
-        self.flags[self.step] = flag
         self.log_probs[self.step] = log_prob
         self.values[self.step] = value
 
+    def push_outcome(self, outcome):
+        self.outcomes[self.step] = outcome
+
         self.step = (self.step + 1) % self.num_steps
 
     def get(self):
-        return (
-            torch.from_numpy(self.states).to(self.device),
-            torch.from_numpy(self.actions).to(self.device),
-            torch.from_numpy(self.rewards).to(self.device),
-            torch.from_numpy(self.flags).to(self.device),
-            torch.from_numpy(self.log_probs).to(self.device),
-            torch.from_numpy(self.values).to(self.device),
-        )
+        return self.states, self.actions, self.rewards, self.flags, self.log_probs, self.values
 
 
 class ActorCriticNet(nn.Module):
     def __init__(self, observation_shape, action_dim, actor_layers, critic_layers, device):
         super().__init__()
 
-        self.actor_net = self._build_net(observation_shape, actor_layers)
-        self.critic_net = self._build_net(observation_shape, critic_layers)
+        # Fuse the first layers of actor and critic
+        self.input_sizes = (actor_layers[0], critic_layers[0])
+        self.input_layer = self._build_linear(np.prod(observation_shape), sum(self.input_sizes), apply_init=False)
+
+        for weight in self.input_layer.weight.split(self.input_sizes):
+            torch.nn.init.orthogonal_(weight, np.sqrt(2))
+        torch.nn.init.constant_(self.input_layer.bias, 0.0)
+
+        self.actor_net = self._build_net(actor_layers)
+        self.critic_net = self._build_net(critic_layers)
 
         self.actor_mean = self._build_linear(actor_layers[-1], action_dim, std=0.01)
         self.actor_std = self._build_linear(actor_layers[-1], action_dim, std=0.01)
@@ -139,45 +248,66 @@ class ActorCriticNet(nn.Module):
 
         return layer
 
-    def _build_net(self, observation_shape, hidden_layers):
+    def _build_net(self, hidden_layers):
         layers = nn.Sequential()
-        in_size = np.prod(observation_shape)
 
-        for out_size in hidden_layers:
+        for in_size, out_size in zip(hidden_layers[:-1], hidden_layers[1:]):
             layers.append(self._build_linear(in_size, out_size))
             layers.append(nn.Tanh())
-            in_size = out_size
 
         return layers
 
+    def _forward_input(self, state):
+        return torch.tanh(self.input_layer(state)).split(self.input_sizes, dim=-1)
+
     def forward(self, state):
-        output = self.actor_net(state)
+        actor_input, critic_input = self._forward_input(state)
+
+        output = self.actor_net(actor_input)
         mean = self.actor_mean(output)
         std = torch.sigmoid(self.actor_std(output)) + 1e-7
-        distribution = Normal(mean, std)
 
-        action = distribution.sample()
-        log_prob = distribution.log_prob(action).sum(-1)
+        action = torch.normal(mean, std)
+        log_prob, _ = normal_log_prob_entropy(mean, std, action)
 
-        value = self.critic_net(state).squeeze(-1)
+        value = self.critic_net(critic_input).squeeze(-1)
 
         return action, log_prob, value
 
     def evaluate(self, states, actions):
-        output = self.actor_net(states)
+        actor_input, critic_input = self._forward_input(states)
+
+        output = self.actor_net(actor_input)
         mean = self.actor_mean(output)
         std = torch.sigmoid(self.actor_std(output)) + 1e-7
-        distribution = Normal(mean, std)
 
-        log_probs = distribution.log_prob(actions).sum(-1)
-        entropy = distribution.entropy().sum(-1)
+        log_probs, entropy = normal_log_prob_entropy(mean, std, actions)
 
-        values = self.critic_net(states).squeeze(-1)
+        values = self.critic_net(critic_input).squeeze(-1)
 
         return log_probs, values, entropy
 
     def critic(self, state):
-        return self.critic_net(state).squeeze(-1)
+        _, critic_input = self._forward_input(state)
+        return self.critic_net(critic_input).squeeze(-1)
+
+
+def save_policy(run_dir, policy, obs_rms=None):
+    torch.save(policy.state_dict(), f"{run_dir}/policy.pt")
+    print(f"Saved policy to {run_dir}/policy.pt")
+
+    # Save the normalizer statistics with the policy
+    if obs_rms is not None:
+        torch.save(obs_rms.state_dict(), f"{run_dir}/obs_rms.pt")
+        print(f"Saved observation normalizer to {run_dir}/obs_rms.pt")
+
+
+def log_metrics(writer, metrics, global_step):
+    # Write the mean of each metric
+    for name, values in metrics.items():
+        writer.add_scalar(name, np.mean([float(value) for value in values]), global_step)
+
+    metrics.clear()
 
 
 def train(args, run_name, run_dir):
@@ -202,7 +332,16 @@ def train(args, run_name, run_dir):
     )
 
     # Create vectorized environment(s)
-    envs = gym.vector.AsyncVectorEnv([make_env(args.env_id) for _ in range(args.num_envs)])
+    if args.sync_envs:
+        envs = gym.vector.SyncVectorEnv([make_env(args.env_id) for _ in range(args.num_envs)])
+    else:
+        # Observations are shared without copy, they are overwritten by the next step
+        envs = gym.vector.AsyncVectorEnv(
+            [make_env(args.env_id) for _ in range(args.num_envs)],
+            shared_memory=True,
+            copy=False,
+            context="forkserver",
+        )
 
     # Metadata about the environment
     observation_shape = envs.single_observation_space.shape
@@ -211,11 +350,9 @@ def train(args, run_name, run_dir):
 
     # Set seed for reproducibility
     if args.seed:
-        numpy_rng = np.random.default_rng(args.seed)
         torch.manual_seed(args.seed)
         state, _ = envs.reset(seed=args.seed)
     else:
-        numpy_rng = np.random.default_rng()
         state, _ = envs.reset()
 
     # Create policy network and optimizer
@@ -223,59 +360,99 @@ def train(args, run_name, run_dir):
     optimizer = optim.Adam(policy.parameters(), lr=args.learning_rate)
     scheduler = optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=lambda epoch: 1.0 - (epoch - 1.0) / args.num_updates)
 
+    # Compile the rollout forward and the loss (https://pytorch.org/docs/stable/torch.compiler.html)
+    policy_step = torch.compile(policy, mode="reduce-overhead") if args.compile else policy
+    loss_fn = torch.compile(compute_loss, mode="reduce-overhead") if args.compile else compute_loss
+
     # Create buffers
     rollout_buffer = RolloutBuffer(args.num_steps, args.num_envs, observation_shape, action_shape, args.device)
 
+    # Create the observation normalizer
+    obs_rms = RunningMeanStd(observation_shape, args.device) if args.normalize_obs else None
+
+    # Create the reward scaler
+    return_rms = RunningMeanStd((), args.device) if args.normalize_reward else None
+    last_return = torch.zeros(args.num_envs, dtype=torch.float32, device=args.device)
+
+    # Create pinned host buffers for the transfers
+    pin_memory = args.device.type == "cuda"
+    state_pin = torch.empty((args.num_envs, *observation_shape), dtype=torch.float32, pin_memory=pin_memory)
+    outcome_pin = torch.empty((args.num_envs, 2), dtype=torch.float32, pin_memory=pin_memory)
+
+    # Numpy view of the pinned rewards and flags
+    outcome_np = outcome_pin.numpy()
+
+    # Host buffer of the episode ends
+    done = np.empty(args.num_envs, dtype=bool)
+
     # Remove unnecessary variables
     del action_dim
 
+    # Bind the constants of the loops to locals
+    num_steps, num_envs, device = args.num_steps, args.num_envs, args.device
+    normalize_obs, normalize_reward, gamma, gae = args.normalize_obs, args.normalize_reward, args.gamma, args.gae
+    num_optims, batch_size, minibatch_size = args.num_optims, args.batch_size, args.minibatch_size
+    fused_minibatches = args.fused_minibatches
+    eps_clip, value_coef, entropy_coef = args.eps_clip, args.value_coef, args.entropy_coef
+    clip_grad_norm = args.clip_grad_norm
+
     global_step = 0
     log_episodic_returns, log_episodic_lengths = [], []
+    metrics = defaultdict(list)
     start_time = time.process_time()
 
     # Main loop
-    for _ in tqdm(range(args.num_updates)):
-        for _ in range(args.num_steps):
+    for update in tqdm(range(args.num_updates)):
+        for _ in range(num_steps):
             # Update global step
-            global_step += 1 * args.num_envs
+            global_step += 1 * num_envs
 
-            with torch.no_grad():
-                # Get action
-                action, log_prob, value = policy(torch.from_numpy(state).to(args.device).float())
+            state_pin.copy_(torch.from_numpy(state))
+            state = state_pin.to(device, non_blocking=True)
 
-            # Perform action
-            action = action.cpu().numpy()
-            next_state, reward, terminated, truncated, infos = envs.step(action)
+            state = obs_rms(state) if normalize_obs else state
+
+            with torch.inference_mode():
+                # Get action
+                action, log_prob, value = policy_step(state)
 
             # Store transition
-            flag = 1.0 - np.logical_or(terminated, truncated)
-            log_prob = log_prob.cpu().numpy()
-            value = value.cpu().numpy()
-            rollout_buffer.push(state, action, reward, flag, log_prob, value)
+            rollout_buffer.push(state, action, log_prob, value)
 
-            state = next_state
+            # Perform action
+            next_state, reward, terminated, truncated, infos = envs.step(action.cpu().numpy())
 
-            if "final_info" not in infos:
-                continue
+            # Store outcome of the transition
+            outcome_np[:, 0] = reward
+            np.logical_not(np.logical_or(terminated, truncated, out=done), out=outcome_np[:, 1])
+            rollout_buffer.push_outcome(outcome_pin.to(device, non_blocking=True))
 
-            # Log episodic return and length
-            for info in infos["final_info"]:
-                if info is None:
-                    continue
+            state = next_state
 
-                log_episodic_returns.append(info["episode"]["r"])
-                log_episodic_lengths.append(info["episode"]["l"])
-                writer.add_scalar("rollout/episodic_return", np.mean(log_episodic_returns[-5:]), global_step)
-                writer.add_scalar("rollout/episodic_length", np.mean(log_episodic_lengths[-5:]), global_step)
+            # Store episodic return and length
+            if "final_info" in infos:
+                for info in infos["final_info"][infos["_final_info"]]:
+                    log_episodic_returns.append(info["episode"]["r"])
+                    log_episodic_lengths.append(info["episode"]["l"])
+                    metrics["rollout/episodic_return"].append(info["episode"]["r"].item())
+                    metrics["rollout/episodic_length"].append(info["episode"]["l"].item())
 
         # Get transition batch
         states, actions, rewards, flags, log_probs, values = rollout_buffer.get()
 
-        with torch.no_grad():
-            last_value = policy.critic(torch.from_numpy(next_state).to(args.device).float())
+        if normalize_reward:
+            returns, last_return = compute_discounted_returns(rewards, flags, last_return, gamma)
+            return_rms.update(returns.reshape(-1))
+            rewards = torch.clamp(rewards / torch.sqrt(return_rms.var + 1e-8), -10.0, 10.0)
+
+        next_state = torch.from_numpy(next_state).to(device).float()
+        next_state = obs_rms(next_state, update=False) if normalize_obs else next_state
+
+        with torch.inference_mode():
+            last_value = policy.critic(next_state)
 
         # Calculate advantages and TD target
-        advantages = compute_advantages(rewards, flags, values, last_value, args)
+        advantages = compute_advantages(rewards, flags, values, last_value, gamma, gae)
         td_target = advantages + values
 
         # Normalize advantages
@@ -289,48 +466,41 @@ def train(args, run_name, run_dir):
         advantages = advantages.reshape(-1)
         values = values.reshape(-1)
 
-        batch_indexes = np.arange(args.batch_size)
-
         clipfracs = []
 
         # Perform PPO update
-        for _ in range(args.num_optims):
+        for _ in range(num_optims):
             # Shuffle batch
-            numpy_rng.shuffle(batch_indexes)
+            batch_indexes = None if fused_minibatches else torch.randperm(batch_size, device=device)
 
             # Perform minibatch updates
-            for start in range(0, args.batch_size, args.minibatch_size):
-                end = start + args.minibatch_size
-                index = batch_indexes[start:end]
-
-                # Calculate new values from minibatch
-                _log_probs, td_predict, entropy = policy.evaluate(states[index], actions[index])
+            for start in range(0, batch_size, minibatch_size):
+                end = start + minibatch_size
+                index = slice(start, end) if batch_indexes is None else batch_indexes[start:end]
 
-                # Calculate ratios
-                logratio = _log_probs - log_probs[index]
-                ratios = logratio.exp()
+                # Calculate losses
+                loss, actor_loss, critic_loss, logratio, ratios = loss_fn(
+                    policy,
+                    states[index],
+                    actions[index],
+                    log_probs[index],
+                    advantages[index],
+                    td_target[index],
+                    eps_clip,
+                    value_coef,
+                    entropy_coef,
+                )
 
                 # Calculate approx_kl (http://joschu.net/blog/kl-approx.html)
-                with torch.no_grad():
+                with torch.inference_mode():
                     old_approx_kl = (-logratio).mean()
                     approx_kl = ((ratios - 1) - logratio).mean()
                     clipfracs += [((ratios - 1.0).abs() > 0.2).float().mean().item()]
 
-                # Calculate surrogates
-                surr1 = advantages[index] * ratios
-                surr2 = advantages[index] * torch.clamp(ratios, 1.0 - args.eps_clip, 1.0 + args.eps_clip)
-
-                # Calculate losses
-                actor_loss = -torch.min(surr1, surr2).mean()
-                critic_loss = mse_loss(td_predict, td_target[index])
-                entropy_loss = entropy.mean()
-
-                loss = actor_loss + critic_loss * args.value_coef - entropy_loss * args.entropy_coef
-
                 # Update policy network
                 optimizer.zero_grad()
                 loss.backward()
-                clip_grad_norm_(policy.parameters(), args.clip_grad_norm)
+                clip_grad_norm_(policy.parameters(), clip_grad_norm)
                 optimizer.step()
 
         # Annealing learning rate
@@ -340,19 +510,24 @@ def train(args, run_name, run_dir):
             np.nan if torch.var(td_target) == 0 else 1 - torch.var(td_target - values) / torch.var(td_target)
         )
 
-        # Log training metrics
-        writer.add_scalar("rollout/SPS", int(global_step / (time.process_time() - start_time)), global_step)
-        writer.add_scalar("train/loss", loss, global_step)
-        writer.add_scalar("train/actor_loss", actor_loss, global_step)
-        writer.add_scalar("train/critic_loss", critic_loss, global_step)
-        writer.add_scalar("train/old_approx_kl", old_approx_kl, global_step)
-        writer.add_scalar("train/approx_kl", approx_kl, global_step)
-        writer.add_scalar("train/clipfrac", np.mean(clipfracs), global_step)
-        writer.add_scalar("train/explained_var", explained_var, global_step)
+        # Store training metrics
+        metrics["rollout/SPS"].append(int(global_step / (time.process_time() - start_time)))
+        metrics["train/loss"].append(loss.detach().clone())
+        metrics["train/actor_loss"].append(actor_loss.detach().clone())
+        metrics["train/critic_loss"].append(critic_loss.detach().clone())
+        metrics["train/old_approx_kl"].append(old_approx_kl)
+        metrics["train/approx_kl"].append(approx_kl)
+        metrics["train/clipfrac"].append(np.mean(clipfracs))
+        metrics["train/explained_var"].append(explained_var)
+
+        if (update + 1) % args.log_interval == 0:
+            log_metrics(writer, metrics, global_step)
+
+    # Log the metrics of the last incomplete interval
+    log_metrics(writer, metrics, global_step)
 
     # Save final policy
-    torch.save(policy.state_dict(), f"{run_dir}/policy.pt")
-    print(f"Saved policy to {run_dir}/policy.pt")
+    save_policy(run_dir, policy, obs_rms)
 
     # Close the environment
     envs.close()
@@ -376,10 +551,15 @@ def eval_and_render(args, run_dir):
     action_dim = np.prod(action_shape)
 
     # Load policy
-    policy = ActorCriticNet(observation_shape, action_dim, args.list_layer, args.device)
+    policy = ActorCriticNet(observation_shape, action_dim, args.actor_layers, args.critic_layers, args.device)
     policy.load_state_dict(torch.load(f"{run_dir}/policy.pt"))
     policy.eval()
 
+    # Normalize observations
+    obs_rms = RunningMeanStd(observation_shape, args.device) if args.normalize_obs else None
+    if args.normalize_obs:
+        obs_rms.load_state_dict(torch.load(f"{run_dir}/obs_rms.pt"))
+
     count_episodes = 0
     list_rewards = []
 
@@ -387,8 +567,10 @@ def eval_and_render(args, run_dir):
 
     # Run episodes
     while count_episodes < 30:
-        with torch.no_grad():
-            action, _, _ = policy(torch.from_numpy(state).to(args.device).float())
+        with torch.inference_mode():
+            state = torch.from_numpy(state).to(args.device).float()
+            state = obs_rms(state, update=False) if args.normalize_obs else state
+            action, _, _ = policy(state)
 
         action = action.cpu().numpy()
         state, _, _, _, infos = env.step(action)
@@ -1,5 +1,6 @@
 import argparse
 import time
+from collections import defaultdict
 from datetime import datetime
 
 import gymnasium as gym
@@ -16,6 +17,7 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--env_id", type=str, default="HalfCheetah-v4")
     parser.add_argument("--total_timesteps", type=int, default=1_000_000)
+    parser.add_argument("--num_envs", type=int, default=1)
     parser.add_argument("--batch_size", type=int, default=64)
     parser.add_argument("--buffer_size", type=int, default=100_000)
     parser.add_argument("--learning_rate", type=float, default=3e-4)
@@ -26,9 +28,16 @@ def parse_args():
     parser.add_argument("--exploration_noise", type=float, default=0.1)
     parser.add_argument("--noise_clip", type=float, default=0.5)
     parser.add_argument("--policy_noise", type=float, default=0.2)
+    parser.add_argument("--noise_chunk_size", type=int, default=4096)
     parser.add_argument("--learning_start", type=int, default=25_000)
     parser.add_argument("--policy_frequency", type=int, default=4)
+    parser.add_argument("--bf16_buffer", action="store_true")
+    parser.add_argument("--sync_envs", action="store_true")
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--cuda_graph", action="store_true")
+    parser.add_argument("--amp", action="store_true")
     parser.add_argument("--cpu", action="store_true")
+    parser.add_argument("--log_interval", type=int, default=1_000)
     parser.add_argument("--capture_video", action="store_true")
     parser.add_argument("--wandb", action="store_true")
     parser.add_argument("--seed", type=int, default=0)
@@ -36,6 +45,13 @@ def parse_args():
     args = parser.parse_args()
 
     args.device = torch.device("cpu" if args.cpu or not torch.cuda.is_available() else "cuda")
+    args.cuda_graph = args.cuda_graph and args.device.type == "cuda"
+    args.amp = args.amp and args.device.type == "cuda"
+    args.num_iterations = int(args.total_timesteps // args.num_envs)
+
+    # The gradient scaler cannot be captured in a CUDA graph
+    if args.amp and args.cuda_graph:
+        parser.error("--amp and --cuda_graph cannot be used together")
 
     return args
 
@@ -60,90 +76,251 @@ def make_env(env_id, capture_video=False, run_dir="."):
     return thunk
 
 
+def make_vector_env(env_id, num_envs, sync_envs):
+    # A single environment is stepped in process
+    if sync_envs or num_envs == 1:
+        return gym.vector.SyncVectorEnv([make_env(env_id) for _ in range(num_envs)])
+
+    # Observations are shared without copy, they are overwritten by the next step
+    return gym.vector.AsyncVectorEnv(
+        [make_env(env_id) for _ in range(num_envs)],
+        shared_memory=True,
+        copy=False,
+        context="forkserver",
+    )
+
+
+def get_finished_episodes(infos):
+    # Statistics of the finished episodes, as Python scalars
+    if "final_info" not in infos:
+        return []
+
+    return [
+        (info["episode"]["r"].item(), info["episode"]["l"].item()) for info in infos["final_info"][infos["_final_info"]]
+    ]
+
+
 class ReplayBuffer:
-    def __init__(self, buffer_size, batch_size, observation_shape, action_shape, numpy_rng, device):
-        self.states = np.zeros((buffer_size, *observation_shape), dtype=np.float32)
-        self.actions = np.zeros((buffer_size, *action_shape), dtype=np.float32)
-        self.rewards = np.zeros((buffer_size,), dtype=np.float32)
-        self.flags = np.zeros((buffer_size,), dtype=np.float32)
+    def __init__(self, buffer_size, batch_size, num_envs, observation_shape, action_shape, device, dtype=torch.float32):
+        fields = (int(np.prod(observation_shape)), int(np.prod(action_shape)))
+
+        # Rows of num_envs transitions, the next state of a transition is read from the next row
+        self.max_size = buffer_size // num_envs
+        self.transitions = torch.zeros((self.max_size, num_envs, sum(fields)), dtype=dtype, device=device)
+        self.outcomes = torch.zeros((self.max_size, num_envs, 2), dtype=torch.float32, device=device)
+        states, actions = self.transitions.split(fields, dim=-1)
+
+        self.states = states.view(self.max_size, num_envs, *observation_shape)
+        self.actions = actions.view(self.max_size, num_envs, *action_shape)
+        self.rewards = self.outcomes[..., 0]
+        self.flags = self.outcomes[..., 1]
+
+        # Pinned host buffer staging the rewards and flags
+        self.outcome_pin = torch.empty((num_envs, 2), dtype=torch.float32, pin_memory=device.type == "cuda")
+        self.outcome_np = self.outcome_pin.numpy()
 
         self.batch_size = batch_size
-        self.max_size = buffer_size
+        self.num_envs = num_envs
         self.idx = 0
         self.size = 0
 
-        self.numpy_rng = numpy_rng
         self.device = device
 
     def push(self, state, action, reward, flag):
+        # State and action are already on device
         self.states[self.idx] = state
         self.actions[self.idx] = action
-        self.rewards[self.idx] = reward
-        self.flags[self.idx] = flag
+
+        self.outcome_np[:, 0] = reward
+        self.outcome_np[:, 1] = flag
+
+        # Copy the outcomes to device
+        self.outcomes[self.idx].copy_(self.outcome_pin, non_blocking=True)
 
         self.idx = (self.idx + 1) % self.max_size
         self.size = min(self.size + 1, self.max_size)
 
     def sample(self):
-        idxs = self.numpy_rng.integers(0, self.size - 1, size=self.batch_size)
+        # The newest step has no next state yet
+        start = self.idx if self.size == self.max_size else 0
+        offsets = torch.randint(0, self.size - 1, (self.batch_size,), device=self.device)
+        envs = torch.randint(0, self.num_envs, (self.batch_size,), device=self.device)
+
+        idxs = (start + offsets) % self.max_size
+        next_idxs = (idxs + 1) % self.max_size
 
         return (
-            torch.from_numpy(self.states[idxs]).to(self.device),
-            torch.from_numpy(self.actions[idxs]).to(self.device),
-            torch.from_numpy(self.rewards[idxs]).to(self.device),
-            torch.from_numpy(self.states[idxs + 1]).to(self.device),
-            torch.from_numpy(self.flags[idxs]).to(self.device),
+            self.states[idxs, envs].to(torch.float32),
+            self.actions[idxs, envs].to(torch.float32),
+            self.rewards[idxs, envs],
+            self.states[next_idxs, envs].to(torch.float32),
+            self.flags[idxs, envs],
         )
 
 
+class NoiseBuffer:
+    def __init__(self, chunk_size, shape, scale, std, clip=float("inf")):
+        # Clipped and scaled Gaussian noise, generated by chunks
+        self.noise = torch.empty((chunk_size, *shape), dtype=torch.float32, device=scale.device)
+
+        self.scale = scale
+        self.std = std
+        self.clip = clip
+        self.chunk_size = chunk_size
+        self.ptr = chunk_size
+
+    def _refill(self):
+        torch.randn(self.noise.shape, out=self.noise)
+        self.noise.mul_(self.std).clamp_(-self.clip, self.clip).mul_(self.scale)
+
+        self.ptr = 0
+
+    def sample(self):
+        if self.ptr == self.chunk_size:
+            self._refill()
+
+        noise = self.noise[self.ptr]
+        self.ptr += 1
+
+        return noise
+
+
+class CUDAGraphStep:
+    def __init__(self, fn, tensors=(), optimizers=(), num_warmup=3):
+        # Captures fn in a CUDA graph (https://pytorch.org/docs/stable/notes/cuda.html#cuda-graphs)
+        self.fn = fn
+        self.tensors = list(tensors)
+        self.optimizers = optimizers
+        self.num_warmup = num_warmup
+        self.graph = None
+
+    def _capture(self, inputs):
+        self.static_inputs = tuple(value.clone() for value in inputs)
+        snapshot = [tensor.detach().clone() for tensor in self.tensors]
+
+        # Warmup on a side stream
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.num_warmup):
+                self.fn(*self.static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # Undo the warmup updates
+        with torch.no_grad():
+            torch._foreach_copy_(self.tensors, snapshot)  # noqa: SLF001
+
+            for optimizer in self.optimizers:
+                for state in optimizer.state.values():
+                    for value in state.values():
+                        if torch.is_tensor(value):
+                            value.zero_()
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_output = self.fn(*self.static_inputs)
+
+    def __call__(self, *inputs):
+        if self.graph is None:
+            self._capture(inputs)
+
+        for static_input, value in zip(self.static_inputs, inputs):
+            static_input.copy_(value)
+
+        self.graph.replay()
+
+        # The static output is overwritten by the next replay
+        return self.static_output
+
+
+def make_update(step_fn, compile_mode, cuda_graph, tensors=(), optimizers=()):
+    # Compile the whole update
+    if compile_mode is not None:
+        step_fn = torch.compile(step_fn, mode=compile_mode)
+
+    # Capture the update in a CUDA graph
+    if cuda_graph:
+        return CUDAGraphStep(step_fn, tensors, optimizers)
+
+    return step_fn
+
+
+class MLP(nn.Module):
+    def __init__(self, in_size, layers, num_nets=None):
+        super().__init__()
+
+        # Weights are stored as (in_size, out_size), stacked on a leading dimension with num_nets
+        stack_shape = () if num_nets is None else (num_nets,)
+        bias_shape = () if num_nets is None else (num_nets, 1)
+
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+
+        for out_size in layers:
+            bound = 1.0 / np.sqrt(in_size)
+            self.weights.append(nn.Parameter(torch.empty((*stack_shape, in_size, out_size)).uniform_(-bound, bound)))
+            self.biases.append(nn.Parameter(torch.empty((*bias_shape, out_size)).uniform_(-bound, bound)))
+            in_size = out_size
+
+        self.matmul = torch.addmm if num_nets is None else torch.baddbmm
+
+    def forward(self, x):
+        # Every layer is a single addmm or baddbmm
+        for weight, bias in zip(self.weights[:-1], self.biases[:-1]):
+            x = torch.relu(self.matmul(bias, x, weight))
+
+        return self.matmul(self.biases[-1], x, self.weights[-1])
+
+
 class ActorCriticNet(nn.Module):
     def __init__(self, observation_shape, action_dim, actor_layers, critic_layers, action_low, action_high, device):
         super().__init__()
 
-        self.actor_net = self._build_net(observation_shape, actor_layers)
-        self.actor_net.append(self._build_linear(actor_layers[-1], action_dim))
+        self.actor_net = MLP(np.prod(observation_shape), [*actor_layers, action_dim])
 
-        self.critic_net1 = self._build_net(np.prod(observation_shape) + action_dim, critic_layers)
-        self.critic_net1.append(self._build_linear(critic_layers[-1], 1))
-
-        self.critic_net2 = self._build_net(np.prod(observation_shape) + action_dim, critic_layers)
-        self.critic_net2.append(self._build_linear(critic_layers[-1], 1))
+        # Twin critics are stacked and run together
+        self.critic_net = MLP(np.prod(observation_shape) + action_dim, [*critic_layers, 1], num_nets=2)
 
         # Scale and bias the output of the network to match the action space
         self.register_buffer("action_scale", ((action_high - action_low) / 2.0))
         self.register_buffer("action_bias", ((action_high + action_low) / 2.0))
 
+        # Scratch input of the critics, resized with the batch size
+        self.register_buffer("critic_input", torch.empty(0), persistent=False)
+
         if device.type == "cuda":
             self.cuda()
 
-    def _build_linear(self, in_size, out_size, apply_init=False, std=np.sqrt(2), bias_const=0.0):
-        layer = nn.Linear(in_size, out_size)
+    def actor(self, state):
+        # Rescale the tanh output to the action space
+        return torch.addcmul(self.action_bias, torch.tanh(self.actor_net(state)), self.action_scale)
 
-        if apply_init:
-            torch.nn.init.orthogonal_(layer.weight, std)
-            torch.nn.init.constant_(layer.bias, bias_const)
+    def critic(self, state, action):
+        if self.critic_input.shape[0] != state.shape[0]:
+            self.critic_input = state.new_empty((state.shape[0], state.shape[1] + action.shape[1]))
+
+        # Both critics read the same input
+        critic_input = self.critic_input.detach()
+        critic_input[:, : state.shape[1]].copy_(state)
+        critic_input[:, state.shape[1] :].copy_(action)
+        critic1, critic2 = self.critic_net(critic_input.expand(2, -1, -1)).squeeze(-1)
+        return critic1, critic2
 
-        return layer
 
-    def _build_net(self, observation_shape, hidden_layers):
-        layers = nn.Sequential()
-        in_size = np.prod(observation_shape)
+def copy_to_pinned(tensor, pinned):
+    # Wait for the copy before the host reads it
+    pinned.copy_(tensor, non_blocking=True)
 
-        for out_size in hidden_layers:
-            layers.append(self._build_linear(in_size, out_size))
-            layers.append(nn.ReLU())
-            in_size = out_size
+    if pinned.is_pinned():
+        torch.cuda.current_stream().synchronize()
 
-        return layers
 
-    def actor(self, state):
-        output = torch.tanh(self.actor_net(state))
-        return output * self.action_scale + self.action_bias
+def log_metrics(writer, metrics, global_step):
+    # Write the mean of each metric
+    for name, values in metrics.items():
+        writer.add_scalar(name, np.mean([float(value) for value in values]), global_step)
 
-    def critic(self, state, action):
-        critic1 = self.critic_net1(torch.cat([state, action], 1)).squeeze()
-        critic2 = self.critic_net2(torch.cat([state, action], 1)).squeeze()
-        return critic1, critic2
+    metrics.clear()
 
 
 def train(args, run_name, run_dir):
@@ -167,8 +344,8 @@ def train(args, run_name, run_dir):
         "|param|value|\n|-|-|\n%s" % ("\n".join([f"|{key}|{value}|" for key, value in vars(args).items()])),
     )
 
-    # Create vectorized environment
-    env = gym.vector.SyncVectorEnv([make_env(args.env_id)])
+    # Create vectorized environment(s)
+    env = make_vector_env(args.env_id, args.num_envs, args.sync_envs)
 
     # Metadata about the environment
     observation_shape = env.single_observation_space.shape
@@ -179,11 +356,9 @@ def train(args, run_name, run_dir):
 
     # Set seed for reproducibility
     if args.seed:
-        numpy_rng = np.random.default_rng(args.seed)
         torch.manual_seed(args.seed)
         state, _ = env.reset(seed=args.seed)
     else:
-        numpy_rng = np.random.default_rng()
         state, _ = env.reset()
 
     # Create the networks and the optimizer
@@ -196,123 +371,216 @@ def train(args, run_name, run_dir):
         action_high,
         args.device,
     )
-    target = ActorCriticNet(
-        observation_shape,
-        action_dim,
-        args.actor_layers,
-        args.critic_layers,
-        action_low,
-        action_high,
-        args.device,
-    )
-    target.load_state_dict(policy.state_dict())
 
-    optimizer_actor = optim.Adam(policy.actor_net.parameters(), lr=args.learning_rate)
-    optimizer_critic = optim.Adam(
-        list(policy.critic_net1.parameters()) + list(policy.critic_net2.parameters()),
-        lr=args.learning_rate,
-    )
+    # Create the target network, its weights are copied from the policy
+    with torch.device("meta"):
+        target = ActorCriticNet(
+            observation_shape,
+            action_dim,
+            args.actor_layers,
+            args.critic_layers,
+            action_low,
+            action_high,
+            torch.device("meta"),
+        )
+    target.to_empty(device=args.device).requires_grad_(False)
+
+    # Parameters of the soft update
+    policy_params = list(policy.parameters())
+    target_params = list(target.parameters())
+
+    # Initialize the target network
+    with torch.no_grad():
+        torch._foreach_copy_([*target_params, *target.buffers()], [*policy_params, *policy.buffers()])  # noqa: SLF001
+
+    # Captured optimizer steps need their states on device
+    actor_params = list(policy.actor_net.parameters())
+    optimizer_actor = optim.Adam(actor_params, lr=args.learning_rate, capturable=args.cuda_graph)
+    optimizer_critic = optim.Adam(policy.critic_net.parameters(), lr=args.learning_rate, capturable=args.cuda_graph)
+
+    # Scale the losses of the float16 autocast
+    actor_scaler = torch.amp.GradScaler("cuda", enabled=args.amp)
+    critic_scaler = torch.amp.GradScaler("cuda", enabled=args.amp)
+
+    # Compile the rollout actor and the training steps (https://pytorch.org/docs/stable/torch.compiler.html)
+    mode = ("default" if args.cuda_graph else "reduce-overhead") if args.compile else None
+    policy_actor = torch.compile(policy.actor, mode=mode) if args.compile else policy.actor
 
     # Create the replay buffer
     replay_buffer = ReplayBuffer(
         args.buffer_size,
         args.batch_size,
+        args.num_envs,
         observation_shape,
         action_shape,
-        numpy_rng,
         args.device,
+        torch.bfloat16 if args.bf16_buffer else torch.float32,
+    )
+
+    # Create the exploration and target policy smoothing noises
+    exploration_noise = NoiseBuffer(
+        args.noise_chunk_size,
+        (args.num_envs, *action_shape),
+        policy.action_scale,
+        args.exploration_noise,
     )
+    target_noise = NoiseBuffer(
+        args.noise_chunk_size,
+        (args.batch_size, *action_shape),
+        target.action_scale,
+        args.policy_noise,
+        args.noise_clip,
+    )
+
+    # Create pinned host buffers for the state and action transfers
+    pin_memory = args.device.type == "cuda"
+    state_pin = torch.empty((args.num_envs, *observation_shape), dtype=torch.float32, pin_memory=pin_memory)
+    action_pin = torch.empty((args.num_envs, *action_shape), dtype=torch.float32, pin_memory=pin_memory)
+    action_np = action_pin.numpy()
+
+    # Host buffer of the episode ends
+    done = np.empty(args.num_envs, dtype=bool)
 
     # Remove unnecessary variables
     del observation_shape, action_shape, action_dim
 
+    def critic_step(states, actions, rewards, next_states, flags, clipped_noise):
+        with torch.autocast(device_type="cuda", dtype=torch.float16, enabled=args.amp):
+            # Not in inference mode, which would turn the scratch input into an inference tensor
+            with torch.no_grad():
+                # Add the smoothing noise and clip to the action space
+                next_state_actions = target.actor(next_states).add_(clipped_noise).clamp_(action_low, action_high)
+                critic1_next_target, critic2_next_target = target.critic(next_states, next_state_actions)
+                min_qf_next_target = torch.min(critic1_next_target, critic2_next_target)
+                next_q_value = rewards + args.gamma * flags * min_qf_next_target
+
+            qf1_a_values, qf2_a_values = policy.critic(states, actions)
+            qf1_loss = mse_loss(qf1_a_values, next_q_value)
+            qf2_loss = mse_loss(qf2_a_values, next_q_value)
+            critic_loss = qf1_loss + qf2_loss
+
+        optimizer_critic.zero_grad()
+        critic_scaler.scale(critic_loss).backward()
+        critic_scaler.step(optimizer_critic)
+        critic_scaler.update()
+
+        # Metrics in the order of critic_metric_names
+        return (
+            torch.stack(
+                [
+                    critic_loss,
+                    qf1_a_values.mean(),
+                    qf2_a_values.mean(),
+                    critic1_next_target.mean(),
+                    critic2_next_target.mean(),
+                    qf1_loss,
+                    qf2_loss,
+                    min_qf_next_target.mean(),
+                    next_q_value.mean(),
+                ],
+            )
+            .float()
+            .detach()
+        )
+
+    def actor_step(states):
+        with torch.autocast(device_type="cuda", dtype=torch.float16, enabled=args.amp):
+            critic1, _ = policy.critic(states, policy.actor(states))
+            actor_loss = -critic1.float().mean()
+
+        # Gradients are only computed for the actor
+        optimizer_actor.zero_grad()
+        actor_scaler.scale(actor_loss).backward(inputs=actor_params)
+        actor_scaler.step(optimizer_actor)
+        actor_scaler.update()
+
+        # Update the target network (soft update)
+        with torch.no_grad():
+            torch._foreach_lerp_(target_params, policy_params, args.tau)  # noqa: SLF001
+
+        return actor_loss.detach()
+
+    critic_metric_names = (
+        "train/critic_loss",
+        "train/qf1_a_values",
+        "train/qf2_a_values",
+        "train/critic1_next_target",
+        "train/critic2_next_target",
+        "train/qf1_loss",
+        "train/qf2_loss",
+        "train/min_qf_next_target",
+        "train/next_q_value",
+    )
+
+    # Create the training steps
+    update_critic = make_update(critic_step, mode, args.cuda_graph, policy_params, [optimizer_critic])
+    update_actor = make_update(actor_step, mode, args.cuda_graph, policy_params + target_params, [optimizer_actor])
+
     log_episodic_returns, log_episodic_lengths = [], []
-    start_time = time.process_time()
+    metrics = defaultdict(list)
+    start_time = time.perf_counter()
+
+    # Transfer the state to device
+    state_pin.copy_(torch.from_numpy(state))
+    state = state_pin.to(args.device, non_blocking=True)
 
     # Main loop
-    for global_step in tqdm(range(args.total_timesteps)):
+    for iteration in tqdm(range(args.num_iterations)):
+        # Each iteration steps all environments
+        global_step = iteration * args.num_envs
+
         if global_step < args.learning_start:
-            action = Uniform(action_low, action_high).sample().unsqueeze(0)
+            action = Uniform(action_low, action_high).sample((args.num_envs,))
         else:
-            with torch.no_grad():
-                state_tensor = torch.from_numpy(state).to(args.device).float()
-                action = policy.actor(state_tensor)
-                action += torch.normal(0, policy.action_scale * args.exploration_noise)
+            with torch.inference_mode():
+                action = policy_actor(state)
+                action += exploration_noise.sample()
 
         # Perform action
-        action = action.cpu().numpy()
-        next_state, reward, terminated, truncated, infos = env.step(action)
+        copy_to_pinned(action, action_pin)
+
+        next_state, reward, terminated, truncated, infos = env.step(action_np)
 
         # Store transition in the replay buffer
-        flag = 1.0 - np.logical_or(terminated, truncated)
+        flag = np.logical_not(np.logical_or(terminated, truncated, out=done), out=done)
         replay_buffer.push(state, action, reward, flag)
 
-        state = next_state
+        # Transfer the next state to device
+        state_pin.copy_(torch.from_numpy(next_state))
+        state = state_pin.to(args.device, non_blocking=True)
 
         # Log episodic return and length
-        if "final_info" in infos:
-            info = infos["final_info"][0]
-
-            log_episodic_returns.append(info["episode"]["r"])
-            log_episodic_lengths.append(info["episode"]["l"])
-            writer.add_scalar("rollout/episodic_return", np.mean(info["episode"]["r"][-5:]), global_step)
-            writer.add_scalar("rollout/episodic_length", np.mean(info["episode"]["l"][-5:]), global_step)
-
-        # Perform training step
-        if global_step > args.learning_start:
+        for episodic_return, episodic_length in get_finished_episodes(infos):
+            log_episodic_returns.append(episodic_return)
+            log_episodic_lengths.append(episodic_length)
+            metrics["rollout/episodic_return"].append(episodic_return)
+            metrics["rollout/episodic_length"].append(episodic_length)
+
+        # Perform one training step per environment step
+        for update_step in range(max(global_step, args.learning_start + 1), global_step + args.num_envs):
             # Sample a batch from the replay buffer
             states, actions, rewards, next_states, flags = replay_buffer.sample()
 
-            # Update critic
-            with torch.no_grad():
-                clipped_noise = (
-                    torch.clamp((torch.randn_like(actions) * args.policy_noise), -args.noise_clip, args.noise_clip)
-                    * target.action_scale
-                )
+            # Update critic, the output is cloned as the next call overwrites it
+            critic_metrics = update_critic(states, actions, rewards, next_states, flags, target_noise.sample()).clone()
 
-                next_state_actions = torch.clamp((target.actor(next_states) + clipped_noise), action_low, action_high)
-                critic1_next_target, critic2_next_target = target.critic(next_states, next_state_actions)
-                min_qf_next_target = torch.min(critic1_next_target, critic2_next_target)
-                next_q_value = rewards + args.gamma * flags * min_qf_next_target
+            # Update actor
+            if not update_step % args.policy_frequency:
+                actor_loss = update_actor(states).clone()
 
-            qf1_a_values, qf2_a_values = policy.critic(states, actions)
-            qf1_loss = mse_loss(qf1_a_values, next_q_value)
-            qf2_loss = mse_loss(qf2_a_values, next_q_value)
-            critic_loss = qf1_loss + qf2_loss
+                metrics["train/actor_loss"].append(actor_loss)
 
-            optimizer_critic.zero_grad()
-            critic_loss.backward()
-            optimizer_critic.step()
+            # Store training metrics
+            for name, value in zip(critic_metric_names, critic_metrics):
+                metrics[name].append(value)
 
-            # Update actor
-            if not global_step % args.policy_frequency:
-                critic1, _ = policy.critic(states, policy.actor(states))
-                actor_loss = -critic1.mean()
-                optimizer_actor.zero_grad()
-                actor_loss.backward()
-                optimizer_actor.step()
-
-                writer.add_scalar("train/actor_loss", actor_loss, global_step)
-
-                # Update the target network (soft update)
-                for param, target_param in zip(policy.actor_net.parameters(), target.actor_net.parameters()):
-                    target_param.data.copy_(args.tau * param.data + (1 - args.tau) * target_param.data)
-                for param, target_param in zip(policy.critic_net1.parameters(), target.critic_net1.parameters()):
-                    target_param.data.copy_(args.tau * param.data + (1 - args.tau) * target_param.data)
-                for param, target_param in zip(policy.critic_net2.parameters(), target.critic_net2.parameters()):
-                    target_param.data.copy_(args.tau * param.data + (1 - args.tau) * target_param.data)
-
-            # Log training metrics
-            writer.add_scalar("rollout/SPS", int(global_step / (time.process_time() - start_time)), global_step)
-            writer.add_scalar("train/critic_loss", critic_loss, global_step)
-            writer.add_scalar("train/qf1_a_values", qf1_a_values.mean(), global_step)
-            writer.add_scalar("train/qf2_a_values", qf2_a_values.mean(), global_step)
-            writer.add_scalar("train/critic1_next_target", critic1_next_target.mean(), global_step)
-            writer.add_scalar("train/critic2_next_target", critic2_next_target.mean(), global_step)
-            writer.add_scalar("train/qf1_loss", qf1_loss, global_step)
-            writer.add_scalar("train/qf2_loss", qf2_loss, global_step)
-            writer.add_scalar("train/min_qf_next_target", min_qf_next_target.mean(), global_step)
-            writer.add_scalar("train/next_q_value", next_q_value.mean(), global_step)
+        # Log training metrics
+        if (global_step + args.num_envs) % args.log_interval < args.num_envs:
+            metrics["rollout/SPS"].append(int(global_step / (time.perf_counter() - start_time)))
+            log_metrics(writer, metrics, global_step)
+
+    # Log the remaining metrics
+    log_metrics(writer, metrics, global_step)
 
     # Save final policy
     torch.save(policy.state_dict(), f"{run_dir}/policy.pt")
@@ -351,7 +619,7 @@ def eval_and_render(args, run_dir):
         action_high,
         args.device,
     )
-    policy.load_state_dict(torch.load(f"{run_dir}/actor.pt"))
+    policy.load_state_dict(torch.load(f"{run_dir}/policy.pt"))
     policy.eval()
 
     count_episodes = 0
@@ -363,7 +631,7 @@ def eval_and_render(args, run_dir):
     while count_episodes < 30:
         with torch.no_grad():
             state = torch.from_numpy(state).to(args.device).float()
-            action = policy(state)
+            action = policy.actor(state)
             action += torch.normal(0, policy.action_scale * args.exploration_noise)
 
         action = action.cpu().numpy()